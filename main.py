@@ -1,31 +1,87 @@
 import os
 import re
+import hmac
+import time
 import logging
-from datetime import datetime
-from urllib.parse import quote, urlparse, parse_qs, parse_qsl, unquote
-from typing import Dict, Any, Optional, Tuple, List
+import unicodedata
+from html import escape
+from datetime import datetime, timedelta
+from functools import lru_cache
+from urllib.parse import quote, urlencode, urlparse, urlunparse, parse_qs, parse_qsl
+from typing import Dict, Any, Optional, Tuple, List, NamedTuple
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.webhook import WebhookRequestHandler
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.utils import executor
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiohttp import web
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'WARNING').upper())
 
 # Получение токена из переменной окружения
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не найден в переменных окружения")
 
+# Вебхук включается, если задан публичный адрес бота (например, https://my-bot.up.railway.app)
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Секрет вебхука: Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+if WEBHOOK_HOST and not WEBHOOK_SECRET:
+    raise ValueError("Для работы через вебхук нужен WEBHOOK_SECRET")
+# По умолчанию обновления, пришедшие за время перезапуска, обрабатываются; 1 — отбросить их
+WEBHOOK_DROP_PENDING_UPDATES = os.getenv('WEBHOOK_DROP_PENDING_UPDATES') == '1'
+WEBAPP_HOST = '0.0.0.0'
+WEBAPP_PORT = int(os.getenv('PORT', '8080'))
+
+# Если задан REDIS_HOST, состояние диалогов хранится в Redis, иначе — в памяти процесса
+REDIS_HOST = os.getenv('REDIS_HOST')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+REDIS_DB = int(os.getenv('REDIS_DB', '5'))
+REDIS_POOL_SIZE = int(os.getenv('REDIS_POOL_SIZE', '50'))
+# Брошенные диалоги удаляются из хранилища через 30 минут
+FSM_TTL_SECONDS = 30 * 60
+
+# Максимум одновременных соединений с Bot API (пул aiohttp-сессии бота), по умолчанию без ограничения
+BOT_CONNECTIONS_LIMIT = int(os.environ['BOT_CONNECTIONS_LIMIT']) if os.getenv('BOT_CONNECTIONS_LIMIT') else None
+
 # Инициализация бота
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+bot = Bot(token=BOT_TOKEN, connections_limit=BOT_CONNECTIONS_LIMIT)
+if REDIS_HOST:
+    from aiogram.contrib.fsm_storage.redis import RedisStorage2
+
+    storage = RedisStorage2(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=REDIS_DB,
+        pool_size=REDIS_POOL_SIZE,
+        prefix='linkbot',
+        state_ttl=FSM_TTL_SECONDS,
+        data_ttl=FSM_TTL_SECONDS
+    )
+else:
+    storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
+
+class StripTextMiddleware(BaseMiddleware):
+    """Обрезает пробелы по краям текста сообщения один раз до вызова обработчиков"""
+
+    async def on_pre_process_message(self, message: types.Message, data: Dict[str, Any]) -> None:
+        if message.text:
+            message.text = message.text.strip()
+
+
+dp.middleware.setup(StripTextMiddleware())
+
 BACK_BUTTON_TEXT = "Назад"
+SKIP_BUTTON_TEXT = "Пропустить"
 GO_APP_NAME = "Go"
 OPEN_APP_GO = "Просто открыть приложение"
 OPEN_APP_OTHER = "Просто открыть приложение"
@@ -38,18 +94,29 @@ APP_ORDER = [
     "Yango",
     "Yango Pro"
 ]
+
+
+class AppConfig(NamedTuple):
+    scheme: str
+    base_url: str
+
+
 APP_CATALOG = {
-    "Драйв": {"scheme": "yandexdrive://", "base_url": "https://drive.go.link/"},
-    "Еда": {"scheme": "eda.yandex://", "base_url": "https://eats.go.link/"},
-    "Про": {"scheme": "taximeter://", "base_url": "https://lecj.adj.st/"},
-    "Go": {"scheme": "yandextaxi://", "base_url": "https://yandex.go.link/"},
-    "Yango": {"scheme": "yandexyango://", "base_url": "https://yango.go.link/"},
-    "Yango Pro": {"scheme": "taximeter://", "base_url": "https://ubq5.adj.st/"}
+    "Драйв": AppConfig(scheme="yandexdrive://", base_url="https://drive.go.link/"),
+    "Еда": AppConfig(scheme="eda.yandex://", base_url="https://eats.go.link/"),
+    "Про": AppConfig(scheme="taximeter://", base_url="https://lecj.adj.st/"),
+    "Go": AppConfig(scheme="yandextaxi://", base_url="https://yandex.go.link/"),
+    "Yango": AppConfig(scheme="yandexyango://", base_url="https://yango.go.link/"),
+    "Yango Pro": AppConfig(scheme="taximeter://", base_url="https://ubq5.adj.st/")
 }
 
 APP_OPTIONS = APP_ORDER
 REATTRIBUTION_OPTIONS = ["Только неактивных от 30 дней", "Реатрибуцировать всех"]
 TEMP_ATTR_OPTIONS = ["Без ограничений", "30 дней"]
+# Множества для проверки ответов; списки выше задают порядок кнопок
+APP_OPTION_SET = frozenset(APP_OPTIONS)
+REATTRIBUTION_OPTION_SET = frozenset(REATTRIBUTION_OPTIONS)
+TEMP_ATTR_OPTION_SET = frozenset(TEMP_ATTR_OPTIONS)
 ACTION_TYPE_OPTIONS = [
     OPEN_APP_GO,
     "Сервис",
@@ -59,6 +126,34 @@ ACTION_TYPE_OPTIONS = [
     "Свой диплинк"
 ]
 SERVICE_OPTIONS = ["Еда", "Лавка", "Драйв", "Маркет", "Самокаты", "Транспорт"]
+# Специальные диплинки для некоторых сервисов
+SPECIAL_SERVICE_MAP = {
+    "Самокаты": "yandextaxi://scooters",
+    "Транспорт": "yandextaxi://masstransit"
+}
+# Стандартные сервисы через external
+STANDARD_SERVICE_MAP = {
+    "Еда": "eats",
+    "Лавка": "grocery",
+    "Драйв": "drive",
+    "Маркет": "market"
+}
+# Диплинки тарифов без схемы приложения
+TARIFF_DEEPLINK_PATHS = {
+    "Эконом": "route?tariffClass=econom",
+    "Комфорт": "route?tariffClass=comfortplus",
+    "Комфорт+": "route?tariffClass=business",
+    "Бизнес": "route?tariffClass=vip&vertical=ultima",
+    "Грузовой": "route?tariffClass=cargo",
+    "Детский": "route?tariffClass=child_tariff",
+    "Межгород": "intercity_main"
+}
+# Готовые трекеры Еды, которые выбираются вместо настройки атрибуции
+EATS_TRACKER_MAP = {
+    "Partners_new": "1c5h66r3_1cye0uen",
+    "SMM": "jrzfg8i_wg988s5",
+    "dineout": "1tfiic8a_1tiyod4w"
+}
 TARIFF_OPTIONS = [
     "Эконом",
     "Комфорт",
@@ -104,46 +199,57 @@ def make_keyboard(buttons=None, include_back=False) -> ReplyKeyboardMarkup:
     return keyboard
 
 
+KEYBOARD_APP = make_keyboard(APP_OPTIONS, include_back=False)
+KEYBOARD_REATTRIBUTION = make_keyboard(REATTRIBUTION_OPTIONS, include_back=True)
+KEYBOARD_TEMP_ATTR = make_keyboard(TEMP_ATTR_OPTIONS, include_back=True)
+KEYBOARD_SERVICE = make_keyboard(SERVICE_OPTIONS, include_back=True)
+KEYBOARD_TARIFF = make_keyboard(TARIFF_OPTIONS, include_back=True)
+KEYBOARD_BACK_ONLY = make_keyboard(include_back=True)
+KEYBOARD_SKIP_BACK = make_keyboard([SKIP_BUTTON_TEXT], include_back=True)
+KEYBOARD_EATS_TRACKER_CHOICE = make_keyboard(
+    ["Настроить атрибуцию", "Partners_new", "SMM", "dineout"],
+    include_back=True
+)
+KEYBOARD_EATS_OPTIONS = make_keyboard(
+    ["Главная Еды", "Магазин", "Коллекции", "Диплинк из URL"],
+    include_back=True
+)
+
+
 def keyboard_app() -> ReplyKeyboardMarkup:
-    return make_keyboard(APP_OPTIONS, include_back=False)
+    return KEYBOARD_APP
 
 
 def keyboard_reattribution() -> ReplyKeyboardMarkup:
-    return make_keyboard(REATTRIBUTION_OPTIONS, include_back=True)
+    return KEYBOARD_REATTRIBUTION
 
 
 def keyboard_temp_attr() -> ReplyKeyboardMarkup:
-    return make_keyboard(TEMP_ATTR_OPTIONS, include_back=True)
+    return KEYBOARD_TEMP_ATTR
 
 
 def keyboard_service() -> ReplyKeyboardMarkup:
-    return make_keyboard(SERVICE_OPTIONS, include_back=True)
+    return KEYBOARD_SERVICE
 
 
 def keyboard_tariff() -> ReplyKeyboardMarkup:
-    return make_keyboard(TARIFF_OPTIONS, include_back=True)
+    return KEYBOARD_TARIFF
 
 
 def keyboard_back_only() -> ReplyKeyboardMarkup:
-    return make_keyboard(include_back=True)
+    return KEYBOARD_BACK_ONLY
 
 
 def keyboard_skip_back() -> ReplyKeyboardMarkup:
-    return make_keyboard(["Пропустить"], include_back=True)
+    return KEYBOARD_SKIP_BACK
 
 
 def keyboard_eats_tracker_choice() -> ReplyKeyboardMarkup:
-    return make_keyboard(
-        ["Настроить атрибуцию", "Partners_new", "SMM", "dineout"],
-        include_back=True
-    )
+    return KEYBOARD_EATS_TRACKER_CHOICE
 
 
 def keyboard_eats_options() -> ReplyKeyboardMarkup:
-    return make_keyboard(
-        ["Главная Еды", "Магазин", "Коллекции", "Диплинк из URL"],
-        include_back=True
-    )
+    return KEYBOARD_EATS_OPTIONS
 
 
 def get_app_name_or_default(app_name: Optional[str]) -> str:
@@ -152,78 +258,85 @@ def get_app_name_or_default(app_name: Optional[str]) -> str:
     return APP_ORDER[0] if APP_ORDER else GO_APP_NAME
 
 
+def get_app_config(app_name: Optional[str]) -> AppConfig:
+    return APP_CATALOG[get_app_name_or_default(app_name)]
+
+
 def get_app_scheme(app_name: Optional[str]) -> str:
-    app_name = get_app_name_or_default(app_name)
-    return APP_CATALOG.get(app_name, APP_CATALOG[GO_APP_NAME])["scheme"]
+    return get_app_config(app_name).scheme
 
 
 def get_app_base_url(app_name: Optional[str]) -> str:
-    app_name = get_app_name_or_default(app_name)
-    return APP_CATALOG.get(app_name, APP_CATALOG[GO_APP_NAME])["base_url"]
+    return get_app_config(app_name).base_url
+
+
+def get_state_scheme(user_data: Dict[str, Any]) -> str:
+    """Схема, сохранённая при выборе приложения (для старых состояний — из каталога)"""
+    return user_data.get('scheme_prefix') or get_app_scheme(user_data.get('app'))
+
+
+# adj_t трекеров по приложениям: (реатрибуция, временная атрибуция) -> трекер
+ADJ_T_MAPS = {
+    GO_APP_NAME: {
+        ('Реатрибуцировать всех', 'Без ограничений'): '1pj8ktrc_1pksjytf',
+        ('Только неактивных от 30 дней', 'Без ограничений'): '1md8ai4n_1mztz3nz',
+        ('Реатрибуцировать всех', '30 дней'): '1p5j0f1z_1pk9ju0y',
+        ('Только неактивных от 30 дней', '30 дней'): '1pi2vjj3_1ppvctfa'
+    },
+    "Драйв": {
+        ('Только неактивных от 30 дней', 'Без ограничений'): '1w1fyjuh',
+        ('Только неактивных от 30 дней', '30 дней'): '1w6rk3g5',
+        ('Реатрибуцировать всех', 'Без ограничений'): '1w1h2sce',
+        ('Реатрибуцировать всех', '30 дней'): '1w1k1t8b'
+    },
+    "Еда": {
+        ('Реатрибуцировать всех', 'Без ограничений'): '1wj02w0e_1woudcyr',
+        ('Только неактивных от 30 дней', 'Без ограничений'): '1w72129e_1ww1am8e',
+        ('Реатрибуцировать всех', '30 дней'): '1w1uhauh_1w3dtcvs',
+        ('Только неактивных от 30 дней', '30 дней'): '1wwnx9c4_1wybzoum'
+    },
+    "Про": {
+        ('Только неактивных от 30 дней', 'Без ограничений'): '1w1w0cie_1wf70eky',
+        ('Только неактивных от 30 дней', '30 дней'): '1whu80dy_1wtdlfwn',
+        ('Реатрибуцировать всех', 'Без ограничений'): '1w7uoyoq_1wsa2db8',
+        ('Реатрибуцировать всех', '30 дней'): '1w7ztrws_1wqmugs1'
+    },
+    "Yango": {
+        ('Только неактивных от 30 дней', 'Без ограничений'): '1wrqmlfd_1wtbr2vt',
+        ('Только неактивных от 30 дней', '30 дней'): '1w3dkzxf_1wksmxnr',
+        ('Реатрибуцировать всех', 'Без ограничений'): '1wlyrbe7_1woa6n8p',
+        ('Реатрибуцировать всех', '30 дней'): '1w6zxhcl_1wfkbjtw'
+    },
+    "Yango Pro": {
+        ('Только неактивных от 30 дней', 'Без ограничений'): '1wcen01x_1wh11pd5',
+        ('Только неактивных от 30 дней', '30 дней'): '1w59mp9k_1wkp0jy5',
+        ('Реатрибуцировать всех', 'Без ограничений'): '1w31vlxu_1w3aa34h',
+        ('Реатрибуцировать всех', '30 дней'): '1wxd0aln_1wzdqopt'
+    }
+}
+# Заглушки для трекеров остальных приложений — будут заменены позже
+ADJ_T_STUB_MAP = {
+    ('Реатрибуцировать всех', 'Без ограничений'): 'TODO_TRACKER_1',
+    ('Только неактивных от 30 дней', 'Без ограничений'): 'TODO_TRACKER_2',
+    ('Реатрибуцировать всех', '30 дней'): 'TODO_TRACKER_3',
+    ('Только неактивных от 30 дней', '30 дней'): 'TODO_TRACKER_4'
+}
 
 
 def get_adj_t_map(app_name: Optional[str]) -> Dict[tuple, str]:
-    app_name = get_app_name_or_default(app_name)
-    if app_name == GO_APP_NAME:
-        return {
-            ('Реатрибуцировать всех', 'Без ограничений'): '1pj8ktrc_1pksjytf',
-            ('Только неактивных от 30 дней', 'Без ограничений'): '1md8ai4n_1mztz3nz',
-            ('Реатрибуцировать всех', '30 дней'): '1p5j0f1z_1pk9ju0y',
-            ('Только неактивных от 30 дней', '30 дней'): '1pi2vjj3_1ppvctfa'
-        }
-    if app_name == "Драйв":
-        return {
-            ('Только неактивных от 30 дней', 'Без ограничений'): '1w1fyjuh',
-            ('Только неактивных от 30 дней', '30 дней'): '1w6rk3g5',
-            ('Реатрибуцировать всех', 'Без ограничений'): '1w1h2sce',
-            ('Реатрибуцировать всех', '30 дней'): '1w1k1t8b'
-        }
-    if app_name == "Еда":
-        return {
-            ('Реатрибуцировать всех', 'Без ограничений'): '1wj02w0e_1woudcyr',
-            ('Только неактивных от 30 дней', 'Без ограничений'): '1w72129e_1ww1am8e',
-            ('Реатрибуцировать всех', '30 дней'): '1w1uhauh_1w3dtcvs',
-            ('Только неактивных от 30 дней', '30 дней'): '1wwnx9c4_1wybzoum'
-        }
-    if app_name == "Про":
-        return {
-            ('Только неактивных от 30 дней', 'Без ограничений'): '1w1w0cie_1wf70eky',
-            ('Только неактивных от 30 дней', '30 дней'): '1whu80dy_1wtdlfwn',
-            ('Реатрибуцировать всех', 'Без ограничений'): '1w7uoyoq_1wsa2db8',
-            ('Реатрибуцировать всех', '30 дней'): '1w7ztrws_1wqmugs1'
-        }
-    if app_name == "Yango":
-        return {
-            ('Только неактивных от 30 дней', 'Без ограничений'): '1wrqmlfd_1wtbr2vt',
-            ('Только неактивных от 30 дней', '30 дней'): '1w3dkzxf_1wksmxnr',
-            ('Реатрибуцировать всех', 'Без ограничений'): '1wlyrbe7_1woa6n8p',
-            ('Реатрибуцировать всех', '30 дней'): '1w6zxhcl_1wfkbjtw'
-        }
-    if app_name == "Yango Pro":
-        return {
-            ('Только неактивных от 30 дней', 'Без ограничений'): '1wcen01x_1wh11pd5',
-            ('Только неактивных от 30 дней', '30 дней'): '1w59mp9k_1wkp0jy5',
-            ('Реатрибуцировать всех', 'Без ограничений'): '1w31vlxu_1w3aa34h',
-            ('Реатрибуцировать всех', '30 дней'): '1wxd0aln_1wzdqopt'
-        }
-    # Заглушки для трекеров остальных приложений — будут заменены позже
-    return {
-        ('Реатрибуцировать всех', 'Без ограничений'): 'TODO_TRACKER_1',
-        ('Только неактивных от 30 дней', 'Без ограничений'): 'TODO_TRACKER_2',
-        ('Реатрибуцировать всех', '30 дней'): 'TODO_TRACKER_3',
-        ('Только неактивных от 30 дней', '30 дней'): 'TODO_TRACKER_4'
-    }
+    return ADJ_T_MAPS.get(get_app_name_or_default(app_name), ADJ_T_STUB_MAP)
+
+
+ACTION_TYPE_OPTIONS_BY_APP = {
+    GO_APP_NAME: ACTION_TYPE_OPTIONS,
+    "Yango": [OPEN_APP_OTHER, "Промокод", "Тариф", "Баннер", "Свой диплинк"],
+    "Еда": [OPEN_APP_OTHER, "Ресторан", "Диплинк из URL", "Свой диплинк"]
+}
+DEFAULT_ACTION_TYPE_OPTIONS = [OPEN_APP_OTHER, "Свой диплинк"]
 
 
 def get_action_type_options(app_name: Optional[str]) -> List[str]:
-    app_name = get_app_name_or_default(app_name)
-    if app_name == GO_APP_NAME:
-        return ACTION_TYPE_OPTIONS
-    if app_name == "Yango":
-        return [OPEN_APP_OTHER, "Промокод", "Тариф", "Баннер", "Свой диплинк"]
-    if app_name == "Еда":
-        return [OPEN_APP_OTHER, "Ресторан", "Диплинк из URL", "Свой диплинк"]
-    return [OPEN_APP_OTHER, "Свой диплинк"]
+    return ACTION_TYPE_OPTIONS_BY_APP.get(get_app_name_or_default(app_name), DEFAULT_ACTION_TYPE_OPTIONS)
 
 
 def get_open_app_deeplink(app_name: Optional[str]) -> str:
@@ -234,8 +347,19 @@ def get_open_app_deeplink(app_name: Optional[str]) -> str:
     return scheme_prefix
 
 
+ACTION_TYPE_KEYBOARDS = {
+    app_name: make_keyboard(get_action_type_options(app_name), include_back=True)
+    for app_name in APP_ORDER
+}
+ACTION_TYPE_OPTION_SETS = {
+    app_name: frozenset(get_action_type_options(app_name))
+    for app_name in APP_ORDER
+}
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
+
 def keyboard_action_type_for_app(app_name: Optional[str]) -> ReplyKeyboardMarkup:
-    return make_keyboard(get_action_type_options(app_name), include_back=True)
+    return ACTION_TYPE_KEYBOARDS[get_app_name_or_default(app_name)]
 
 
 def build_reattribution_text(app_name: Optional[str] = None) -> str:
@@ -248,6 +372,13 @@ def build_reattribution_text(app_name: Optional[str] = None) -> str:
     return base_question
 
 
+REATTRIBUTION_TEXTS = {app_name: build_reattribution_text(app_name) for app_name in APP_ORDER}
+CUSTOM_DEEPLINK_TEXTS = {
+    app_name: f"🔗 Введи свой диплинк в формате {get_app_scheme(app_name)}mydeeplink:"
+    for app_name in APP_ORDER
+}
+
+
 def build_temp_attr_text() -> str:
     return "⏰ Сколько пользователь должен оставаться в трекере после последнего контакта?"
 
@@ -273,7 +404,7 @@ async def prompt_reattribution(
     app_name: Optional[str] = None,
     error_prefix: Optional[str] = None
 ) -> None:
-    text = build_reattribution_text(app_name)
+    text = REATTRIBUTION_TEXTS.get(app_name) or build_reattribution_text(app_name)
     if error_prefix:
         text = f"{error_prefix}\n\n{text}"
     await message.answer(text, reply_markup=keyboard_reattribution())
@@ -399,9 +530,8 @@ async def prompt_banner_id(message: types.Message) -> None:
 
 async def prompt_custom_deeplink(message: types.Message, state: FSMContext) -> None:
     user_data = await state.get_data()
-    scheme_prefix = get_app_scheme(user_data.get("app"))
     await message.answer(
-        f"🔗 Введи свой диплинк в формате {scheme_prefix}mydeeplink:",
+        CUSTOM_DEEPLINK_TEXTS[get_app_name_or_default(user_data.get("app"))],
         reply_markup=keyboard_back_only()
     )
     await LinkBuilder.waiting_for_custom_deeplink.set()
@@ -423,34 +553,85 @@ async def prompt_route_end(message: types.Message) -> None:
     await LinkBuilder.waiting_for_route_end.set()
 
 
+# Следующий шаг для каждого типа действия (кроме «Просто открыть приложение»)
+ACTION_TYPE_PROMPTS = {
+    "Сервис": lambda message, state: prompt_service(message),
+    "Промокод": lambda message, state: prompt_promo_code(message),
+    "Тариф": lambda message, state: prompt_tariff(message),
+    "Баннер": lambda message, state: prompt_banner_id(message),
+    "Ресторан": lambda message, state: prompt_eats_restaurant_url(message),
+    "Диплинк из URL": lambda message, state: prompt_eats_url_deeplink(message),
+    "Свой диплинк": prompt_custom_deeplink
+}
+# Куда возвращаться по кнопке «Назад» с шага десктопного URL
+BACK_FROM_DESKTOP_PROMPTS = {
+    "Промокод": lambda message, state: prompt_promo_code(message),
+    "Баннер": lambda message, state: prompt_banner_id(message),
+    "Свой диплинк": prompt_custom_deeplink,
+    "Сервис": lambda message, state: prompt_service(message)
+}
+
+
+CYRILLIC_TO_LATIN = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+    'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya'
+})
+NON_LATIN_ALNUM_RE = re.compile(r'[^a-z0-9]+')
+
+
+@lru_cache(maxsize=1024)
 def transliterate_to_latin(text: str) -> str:
     """Транслитерация кириллицы в латиницу и удаление спецсимволов"""
-    cyrillic_to_latin = {
-        'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo',
-        'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
-        'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
-        'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
-        'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya'
-    }
-    
-    result = ""
-    for char in text.lower():
-        if char in cyrillic_to_latin:
-            result += cyrillic_to_latin[char]
-        elif char.isalnum():
-            result += char
-        # Спецсимволы игнорируем
-    
-    return result
+    # Латинские названия не нужно ни нормализовать, ни транслитерировать
+    if text.isascii():
+        return NON_LATIN_ALNUM_RE.sub('', text.lower())
+    # Буквы с диакритикой, набранные составными символами (и + ˘), собираем в й/ё
+    text = unicodedata.normalize('NFC', text)
+    # Названия чаще всего уже в нижнем регистре — тогда лишнюю копию строки не создаём
+    if not text.islower():
+        text = text.lower()
+    # Всё, что не стало латиницей или цифрой, в adj_adgroup не попадает
+    return NON_LATIN_ALNUM_RE.sub('', text.translate(CYRILLIC_TO_LATIN))
+
+
+_today_cache = {'expires_at': 0.0, 'value': ''}
+
+
+def get_today_str() -> str:
+    """Текущая дата в формате YYYYMMDD, пересчитывается раз в сутки в полночь"""
+    if time.time() >= _today_cache['expires_at']:
+        now = datetime.now()
+        next_midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        _today_cache['value'] = now.strftime('%Y%m%d')
+        _today_cache['expires_at'] = next_midnight.timestamp()
+    return _today_cache['value']
+
+
+URL_RE = re.compile(r'^https?://[^\s/?#]', re.IGNORECASE)
 
 
 def is_valid_url(url: str) -> bool:
     """Проверка валидности URL"""
-    try:
-        result = urlparse(url)
-        return all([result.scheme, result.netloc])
-    except:
-        return False
+    return URL_RE.match(url) is not None
+
+
+def is_skip_text(text: str) -> bool:
+    """Ответ «Пропустить» в любом регистре; длинные ответы (URL, адреса) не копируются через lower()"""
+    return len(text) == len(SKIP_BUTTON_TEXT) and text.lower() == SKIP_BUTTON_TEXT.lower()
+
+
+# Символы, которые quote() оставляет как есть
+URL_SAFE_RE = re.compile(r'[A-Za-z0-9_.~/-]*')
+
+
+def quote_param(value: str) -> str:
+    """URL-кодирование значения параметра; обычные коды возвращаются без копирования"""
+    if URL_SAFE_RE.fullmatch(value):
+        return value
+    return quote(value)
 
 
 def normalize_desktop_url(desktop_url: Optional[str], campaign_value: str, adgroup_value: str) -> Optional[str]:
@@ -458,6 +639,11 @@ def normalize_desktop_url(desktop_url: Optional[str], campaign_value: str, adgro
         return None
 
     parsed_url = urlparse(desktop_url)
+    if not parsed_url.query:
+        # Частый случай — ссылка без параметров: utm-значения из [a-z0-9_] кодировать не нужно
+        new_query = f"utm_source={campaign_value}&utm_campaign={adgroup_value}"
+        return urlunparse(parsed_url._replace(query=new_query))
+
     query_params = parse_qs(parsed_url.query, keep_blank_values=True)
 
     if 'utm_source' not in query_params:
@@ -466,112 +652,157 @@ def normalize_desktop_url(desktop_url: Optional[str], campaign_value: str, adgro
     if 'utm_campaign' not in query_params:
         query_params['utm_campaign'] = [adgroup_value]
 
-    query_parts = []
-    for key, values in query_params.items():
-        for value in values:
-            if value:
-                query_parts.append(f"{key}={quote(str(value))}")
-            else:
-                query_parts.append(key)
+    # Пустые значения сериализуются как "key=", это эквивалентно "key"
+    new_query = urlencode(query_params, doseq=True, safe='/', quote_via=quote)
+    return urlunparse(parsed_url._replace(query=new_query))
+
 
-    if query_parts:
-        new_query = '&'.join(query_parts)
-        desktop_url = f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path}?{new_query}"
-        if parsed_url.fragment:
-            desktop_url += f"#{parsed_url.fragment}"
+def split_deeplink(deeplink: str, scheme_prefix: str) -> Tuple[str, bool]:
+    """Отделяет схему приложения от диплинка и проверяет, есть ли в нём параметры"""
+    deeplink = deeplink.removeprefix(scheme_prefix)
+    return deeplink, '?' in deeplink
+
+
+def resolve_adj_t(
+    app_name: str,
+    reattribution: str,
+    temporary_attribution: str,
+    adj_t_override: Optional[str]
+) -> str:
+    """Трекер для выбранных опций атрибуции (или явно заданный трекер)"""
+    if adj_t_override:
+        return adj_t_override
+    adj_t_map = get_adj_t_map(app_name)
+    return adj_t_map.get(
+        (reattribution, temporary_attribution),
+        next(iter(adj_t_map.values()))
+    )
 
-    return desktop_url
 
+def get_adgroup_value(user_data: Dict[str, Any]) -> str:
+    """adj_adgroup, посчитанный при вводе кампании (для старых состояний — на месте)"""
+    adgroup_value = user_data.get('adgroup_value')
+    if adgroup_value is None:
+        adgroup_value = transliterate_to_latin(user_data.get('campaign_name', ''))
+    return adgroup_value
 
-def build_final_link(user_data: Dict[str, Any]) -> str:
+
+def build_final_link(
+    app_name: str,
+    deeplink: str,
+    adgroup_value: str,
+    reattribution: str,
+    temporary_attribution: str,
+    adj_t_override: Optional[str],
+    desktop_url: Optional[str]
+) -> str:
     """Построение финальной ссылки"""
-    # Базовая часть ссылки
-    app_name = user_data.get('app', GO_APP_NAME)
-    base_url = get_app_base_url(app_name)
-    scheme_prefix = get_app_scheme(app_name)
+    return _build_final_link_cached(
+        app_name,
+        deeplink,
+        adgroup_value,
+        reattribution,
+        temporary_attribution,
+        adj_t_override,
+        desktop_url,
+        get_today_str()
+    )
+
+
+@lru_cache(maxsize=4096)
+def _build_final_link_cached(
+    app_name: str,
+    deeplink: str,
+    adgroup_value: str,
+    reattribution: str,
+    temporary_attribution: str,
+    adj_t_override: Optional[str],
+    desktop_url: Optional[str],
+    today: str
+) -> str:
+    # Базовая часть ссылки и схема берутся из одной записи каталога
+    app_config = get_app_config(app_name)
+    base_url = app_config.base_url
+    scheme_prefix = app_config.scheme
     
     # Получаем диплинк
-    deeplink = user_data.get('deeplink', '')
-    if deeplink.startswith(scheme_prefix):
-        deeplink = deeplink[len(scheme_prefix):]
+    deeplink, deeplink_has_query = split_deeplink(deeplink, scheme_prefix)
     
     # Параметры
-    today = datetime.now().strftime('%Y%m%d')
     campaign_value = f'{today}_bot'
-    adgroup_value = transliterate_to_latin(user_data.get('campaign_name', ''))
     
     # Определяем adj_t на основе выбранных опций
-    reattribution = user_data.get('reattribution', 'Только неактивных от 30 дней')
-    temporary_attribution = user_data.get('temporary_attribution', 'Без ограничений')
-    
-    adj_t_override = user_data.get('adj_t_override')
-    if adj_t_override:
-        adj_t = adj_t_override
-    else:
-        adj_t_map = get_adj_t_map(app_name)
-        adj_t = adj_t_map.get(
-            (reattribution, temporary_attribution),
-            next(iter(adj_t_map.values()))
-        )
+    adj_t = resolve_adj_t(app_name, reattribution, temporary_attribution, adj_t_override)
     
-    params = {
-        'adj_t': adj_t,
-        'adj_campaign': campaign_value,
-        'adj_adgroup': adgroup_value
-    }
+    # adj_t, дата и транслитерированное название состоят только из [a-z0-9_],
+    # поэтому обязательные параметры не нуждаются в кодировании
+    param_string = f'adj_t={adj_t}&adj_campaign={campaign_value}&adj_adgroup={adgroup_value}'
     
     # Обрабатываем desktop_url если есть
-    desktop_url = normalize_desktop_url(user_data.get('desktop_url'), campaign_value, adgroup_value)
+    desktop_url = normalize_desktop_url(desktop_url, campaign_value, adgroup_value)
     if desktop_url:
-        params['adj_fallback'] = quote(desktop_url)
-        params['adj_redirect_macos'] = quote(desktop_url)
-    
-    # Строим URL
-    param_string = '&'.join([f'{k}={v}' for k, v in params.items()])
+        encoded_desktop_url = quote(desktop_url)
+        param_string += f'&adj_fallback={encoded_desktop_url}&adj_redirect_macos={encoded_desktop_url}'
     
     # Определяем разделитель - ? если в deeplink нет параметров, & если есть
-    separator = '&' if '?' in deeplink else '?'
+    separator = '&' if deeplink_has_query else '?'
     final_url = f"{base_url}{deeplink}{separator}{param_string}"
     
     return final_url
 
 
-def build_adjust_app_link(user_data: Dict[str, Any]) -> str:
+def build_adjust_app_link(
+    app_name: str,
+    deeplink: str,
+    adgroup_value: str,
+    reattribution: str,
+    temporary_attribution: str,
+    adj_t_override: Optional[str],
+    desktop_url: Optional[str]
+) -> str:
     """Построение ссылки app.adjust.com"""
-    app_name = user_data.get('app', GO_APP_NAME)
+    return _build_adjust_app_link_cached(
+        app_name,
+        deeplink,
+        adgroup_value,
+        reattribution,
+        temporary_attribution,
+        adj_t_override,
+        desktop_url,
+        get_today_str()
+    )
+
+
+@lru_cache(maxsize=4096)
+def _build_adjust_app_link_cached(
+    app_name: str,
+    deeplink: str,
+    adgroup_value: str,
+    reattribution: str,
+    temporary_attribution: str,
+    adj_t_override: Optional[str],
+    desktop_url: Optional[str],
+    today: str
+) -> str:
     scheme_prefix = get_app_scheme(app_name)
-    deeplink = user_data.get('deeplink', '')
-    if not deeplink.startswith(scheme_prefix):
-        deeplink = f"{scheme_prefix}{deeplink}"
+    deeplink_tail, _ = split_deeplink(deeplink, scheme_prefix)
+    deeplink = f"{scheme_prefix}{deeplink_tail}"
 
-    today = datetime.now().strftime('%Y%m%d')
     campaign_value = f'{today}_bot'
-    adgroup_value = transliterate_to_latin(user_data.get('campaign_name', ''))
-
-    reattribution = user_data.get('reattribution', 'Только неактивных от 30 дней')
-    temporary_attribution = user_data.get('temporary_attribution', 'Без ограничений')
-    adj_t_override = user_data.get('adj_t_override')
-    if adj_t_override:
-        adj_t = adj_t_override
-    else:
-        adj_t_map = get_adj_t_map(app_name)
-        adj_t = adj_t_map.get(
-            (reattribution, temporary_attribution),
-            next(iter(adj_t_map.values()))
-        )
+    adj_t = resolve_adj_t(app_name, reattribution, temporary_attribution, adj_t_override)
 
     params = {
         'campaign': campaign_value,
         'adgroup': adgroup_value,
-        'deeplink': quote(deeplink)
+        'deeplink': deeplink
     }
 
-    desktop_url = normalize_desktop_url(user_data.get('desktop_url'), campaign_value, adgroup_value)
+    desktop_url = normalize_desktop_url(desktop_url, campaign_value, adgroup_value)
     if desktop_url:
-        params['fallback'] = quote(desktop_url)
-        params['redirect_macos'] = quote(desktop_url)
+        params['fallback'] = desktop_url
+        params['redirect_macos'] = desktop_url
 
-    param_string = '&'.join([f'{k}={v}' for k, v in params.items()])
+    param_string = urlencode(params, safe='/', quote_via=quote)
     return f"https://app.adjust.com/{adj_t}?{param_string}"
 
 
@@ -584,20 +815,20 @@ async def cmd_start(message: types.Message):
 @dp.message_handler(state=LinkBuilder.waiting_for_app)
 async def process_app(message: types.Message, state: FSMContext):
     """Обработка выбора приложения"""
-    app_name = message.text.strip()
+    app_name = message.text
     
     if app_name == BACK_BUTTON_TEXT:
         await prompt_app(message)
         return
 
-    if app_name not in APP_OPTIONS:
+    if app_name not in APP_OPTION_SET:
         await message.answer(
             "❌ Пожалуйста, выбери одно из приложений кнопкой ниже:",
             reply_markup=keyboard_app()
         )
         return
     
-    await state.update_data(app=app_name)
+    await state.update_data(app=app_name, scheme_prefix=get_app_scheme(app_name))
 
     if app_name == "Еда":
         await prompt_eats_tracker_choice(message)
@@ -609,24 +840,18 @@ async def process_app(message: types.Message, state: FSMContext):
 @dp.message_handler(state=LinkBuilder.waiting_for_eats_tracker_choice)
 async def process_eats_tracker_choice(message: types.Message, state: FSMContext):
     """Обработка выбора трекера для Еды"""
-    choice = message.text.strip()
+    choice = message.text
 
     if choice == BACK_BUTTON_TEXT:
         await prompt_app(message)
         return
 
-    tracker_map = {
-        "Partners_new": "1c5h66r3_1cye0uen",
-        "SMM": "jrzfg8i_wg988s5",
-        "dineout": "1tfiic8a_1tiyod4w"
-    }
-
     if choice == "Настроить атрибуцию":
         await prompt_reattribution(message, app_name="Еда")
         return
 
-    if choice in tracker_map:
-        await state.update_data(adj_t_override=tracker_map[choice])
+    if choice in EATS_TRACKER_MAP:
+        await state.update_data(adj_t_override=EATS_TRACKER_MAP[choice])
         await prompt_campaign(message)
         return
 
@@ -639,13 +864,13 @@ async def process_eats_tracker_choice(message: types.Message, state: FSMContext)
 @dp.message_handler(state=LinkBuilder.waiting_for_reattribution)
 async def process_reattribution(message: types.Message, state: FSMContext):
     """Обработка выбора реатрибуции"""
-    reattribution = message.text.strip()
+    reattribution = message.text
     
     if reattribution == BACK_BUTTON_TEXT:
         await prompt_app(message)
         return
 
-    if reattribution not in REATTRIBUTION_OPTIONS:
+    if reattribution not in REATTRIBUTION_OPTION_SET:
         await prompt_reattribution(
             message,
             error_prefix="❌ Пожалуйста, используй кнопки для ответа."
@@ -660,13 +885,13 @@ async def process_reattribution(message: types.Message, state: FSMContext):
 @dp.message_handler(state=LinkBuilder.waiting_for_temporary_attribution)
 async def process_temporary_attribution(message: types.Message, state: FSMContext):
     """Обработка выбора временной атрибуции"""
-    temporary_attribution = message.text.strip()
+    temporary_attribution = message.text
     
     if temporary_attribution == BACK_BUTTON_TEXT:
         await prompt_reattribution(message)
         return
 
-    if temporary_attribution not in TEMP_ATTR_OPTIONS:
+    if temporary_attribution not in TEMP_ATTR_OPTION_SET:
         await prompt_temp_attr(
             message,
             error_prefix="❌ Пожалуйста, используй кнопки для ответа."
@@ -681,7 +906,7 @@ async def process_temporary_attribution(message: types.Message, state: FSMContex
 @dp.message_handler(state=LinkBuilder.waiting_for_campaign)
 async def process_campaign(message: types.Message, state: FSMContext):
     """Обработка названия кампании"""
-    campaign_name = message.text.strip()
+    campaign_name = message.text
     
     if campaign_name == BACK_BUTTON_TEXT:
         await prompt_temp_attr(message)
@@ -691,7 +916,10 @@ async def process_campaign(message: types.Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, введи название кампании одним словом:")
         return
     
-    await state.update_data(campaign_name=campaign_name)
+    await state.update_data(
+        campaign_name=campaign_name,
+        adgroup_value=transliterate_to_latin(campaign_name)
+    )
     
     await prompt_action_type_with_state(message, state)
 
@@ -699,7 +927,7 @@ async def process_campaign(message: types.Message, state: FSMContext):
 @dp.message_handler(state=LinkBuilder.waiting_for_action_type)
 async def process_action_type(message: types.Message, state: FSMContext):
     """Обработка типа действия"""
-    action = message.text.strip()
+    action = message.text
     
     if action == BACK_BUTTON_TEXT:
         await prompt_campaign(message)
@@ -707,7 +935,7 @@ async def process_action_type(message: types.Message, state: FSMContext):
 
     user_data = await state.get_data()
     app_name = user_data.get("app", GO_APP_NAME)
-    allowed_actions = get_action_type_options(app_name)
+    allowed_actions = ACTION_TYPE_OPTION_SETS[get_app_name_or_default(app_name)]
 
     if action not in allowed_actions:
         await message.answer(
@@ -721,47 +949,15 @@ async def process_action_type(message: types.Message, state: FSMContext):
     if action in [OPEN_APP_GO, OPEN_APP_OTHER]:
         await state.update_data(deeplink=get_open_app_deeplink(app_name))
         await ask_desktop_url(message, state)
-        
-    elif action == "Сервис":
-        await prompt_service(message)
-        
-    elif action == "Промокод":
-        await prompt_promo_code(message)
-        
-    elif action == "Тариф":
-        await prompt_tariff(message)
-        
-    elif action == "Баннер":
-        await prompt_banner_id(message)
-        
-    elif action == "Ресторан":
-        await prompt_eats_restaurant_url(message)
-
-    elif action == "Диплинк из URL":
-        await prompt_eats_url_deeplink(message)
+        return
 
-    elif action == "Свой диплинк":
-        await prompt_custom_deeplink(message, state)
+    await ACTION_TYPE_PROMPTS[action](message, state)
 
 
 @dp.message_handler(state=LinkBuilder.waiting_for_service)
 async def process_service(message: types.Message, state: FSMContext):
     """Обработка выбора сервиса"""
-    # Специальные диплинки для некоторых сервисов
-    special_service_map = {
-        "Самокаты": "yandextaxi://scooters",
-        "Транспорт": "yandextaxi://masstransit"
-    }
-    
-    # Стандартные сервисы через external
-    standard_service_map = {
-        "Еда": "eats",
-        "Лавка": "grocery", 
-        "Драйв": "drive",
-        "Маркет": "market"
-    }
-    
-    service_name = message.text.strip()
+    service_name = message.text
     
     if service_name == BACK_BUTTON_TEXT:
         await prompt_action_type_with_state(message, state)
@@ -772,11 +968,11 @@ async def process_service(message: types.Message, state: FSMContext):
         return
 
     # Проверяем специальные диплинки
-    if service_name in special_service_map:
-        deeplink = special_service_map[service_name]
+    if service_name in SPECIAL_SERVICE_MAP:
+        deeplink = SPECIAL_SERVICE_MAP[service_name]
     # Проверяем стандартные сервисы
-    elif service_name in standard_service_map:
-        service_code = standard_service_map[service_name]
+    elif service_name in STANDARD_SERVICE_MAP:
+        service_code = STANDARD_SERVICE_MAP[service_name]
         deeplink = f"yandextaxi://external?service={service_code}"
     else:
         await message.answer("❌ Пожалуйста, выбери один из предложенных сервисов.")
@@ -789,7 +985,7 @@ async def process_service(message: types.Message, state: FSMContext):
 @dp.message_handler(state=LinkBuilder.waiting_for_eats_option)
 async def process_eats_option(message: types.Message, state: FSMContext):
     """Обработка выбора опции Еды"""
-    eats_option = message.text.strip()
+    eats_option = message.text
 
     if eats_option == BACK_BUTTON_TEXT:
         await prompt_service(message)
@@ -818,6 +1014,10 @@ async def process_eats_option(message: types.Message, state: FSMContext):
     )
 
 
+# Домены Еды, ссылки с которых можно превратить в диплинк
+EATS_HOST_PREFIXES = ("eda.yandex", "eats.yandex.com")
+
+
 def build_eats_shop_deeplink(shop_url: str) -> Optional[str]:
     try:
         parsed = urlparse(shop_url)
@@ -825,7 +1025,7 @@ def build_eats_shop_deeplink(shop_url: str) -> Optional[str]:
         return None
 
     host = parsed.netloc.lower()
-    if not (host.startswith("eda.yandex") or host.startswith("eats.yandex.com")):
+    if not host.startswith(EATS_HOST_PREFIXES):
         return None
 
     path = parsed.path or ""
@@ -888,7 +1088,7 @@ def extract_eats_tail_from_url(source_url: str) -> Optional[str]:
         return None
 
     host = parsed.netloc.lower()
-    if not (host.startswith("eda.yandex") or host.startswith("eats.yandex.com")):
+    if not host.startswith(EATS_HOST_PREFIXES):
         return None
 
     segments = [segment for segment in parsed.path.split("/") if segment]
@@ -919,7 +1119,7 @@ def build_eats_url_deeplink(source_url: str) -> Optional[str]:
 @dp.message_handler(state=LinkBuilder.waiting_for_eats_shop_url)
 async def process_eats_shop_url(message: types.Message, state: FSMContext):
     """Обработка ссылки на магазин Еды"""
-    shop_url = message.text.strip()
+    shop_url = message.text
 
     if shop_url == BACK_BUTTON_TEXT:
         await prompt_eats_option(message)
@@ -940,7 +1140,7 @@ async def process_eats_shop_url(message: types.Message, state: FSMContext):
 @dp.message_handler(state=LinkBuilder.waiting_for_eats_collections_url)
 async def process_eats_collections_url(message: types.Message, state: FSMContext):
     """Обработка ссылки на коллекцию Еды"""
-    collections_url = message.text.strip()
+    collections_url = message.text
 
     if collections_url == BACK_BUTTON_TEXT:
         await prompt_eats_option(message)
@@ -961,7 +1161,7 @@ async def process_eats_collections_url(message: types.Message, state: FSMContext
 @dp.message_handler(state=LinkBuilder.waiting_for_eats_service_url_deeplink)
 async def process_eats_service_url_deeplink(message: types.Message, state: FSMContext):
     """Обработка URL для диплинка сервиса Еда в Go"""
-    source_url = message.text.strip()
+    source_url = message.text
 
     if source_url == BACK_BUTTON_TEXT:
         await prompt_eats_option(message)
@@ -983,7 +1183,7 @@ async def process_eats_service_url_deeplink(message: types.Message, state: FSMCo
 @dp.message_handler(state=LinkBuilder.waiting_for_eats_restaurant_url)
 async def process_eats_restaurant_url(message: types.Message, state: FSMContext):
     """Обработка ссылки на ресторан Еды"""
-    restaurant_url = message.text.strip()
+    restaurant_url = message.text
 
     if restaurant_url == BACK_BUTTON_TEXT:
         await prompt_action_type_with_state(message, state)
@@ -1004,7 +1204,7 @@ async def process_eats_restaurant_url(message: types.Message, state: FSMContext)
 @dp.message_handler(state=LinkBuilder.waiting_for_eats_url_deeplink)
 async def process_eats_url_deeplink(message: types.Message, state: FSMContext):
     """Обработка URL для диплинка Еды"""
-    source_url = message.text.strip()
+    source_url = message.text
 
     if source_url == BACK_BUTTON_TEXT:
         await prompt_action_type_with_state(message, state)
@@ -1025,13 +1225,13 @@ async def process_eats_url_deeplink(message: types.Message, state: FSMContext):
 @dp.message_handler(state=LinkBuilder.waiting_for_route_start)
 async def process_route_start(message: types.Message, state: FSMContext):
     """Обработка адреса отправления"""
-    start_address = message.text.strip()
+    start_address = message.text
     
     if start_address == BACK_BUTTON_TEXT:
         await prompt_tariff(message)
         return
 
-    if start_address.lower() == "пропустить":
+    if is_skip_text(start_address):
         start_address = ""
     
     await state.update_data(start_address=start_address)
@@ -1042,46 +1242,46 @@ async def process_route_start(message: types.Message, state: FSMContext):
 @dp.message_handler(state=LinkBuilder.waiting_for_route_end)
 async def process_route_end(message: types.Message, state: FSMContext):
     """Обработка адреса назначения"""
-    end_address = message.text.strip()
+    end_address = message.text
     
     if end_address == BACK_BUTTON_TEXT:
         await prompt_route_start(message)
         return
 
-    if end_address.lower() == "пропустить":
+    if is_skip_text(end_address):
         end_address = ""
     
     user_data = await state.get_data()
     start_address = user_data.get('start_address', '')
     base_tariff_deeplink = user_data.get('base_tariff_deeplink', '')
-    scheme_prefix = get_app_scheme(user_data.get("app"))
+    scheme_prefix = get_state_scheme(user_data)
     
-    # Формируем параметры маршрута
-    route_params = []
-    if start_address:
-        route_params.append(f"start={quote(start_address)}")
-    if end_address:
-        route_params.append(f"end={quote(end_address)}")
+    # Формируем параметры маршрута (пустые адреса пропускаем)
+    route_query = urlencode(
+        {key: value for key, value in (('start', start_address), ('end', end_address)) if value},
+        safe='/',
+        quote_via=quote
+    )
     
     # Объединяем тарифные и маршрутные параметры
     if base_tariff_deeplink:
         if base_tariff_deeplink == f"{scheme_prefix}intercity_main":
             # Для межгорода используем специальную логику
-            if route_params:
-                deeplink = f"{scheme_prefix}intercity_main?{'&'.join(route_params)}"
+            if route_query:
+                deeplink = f"{scheme_prefix}intercity_main?{route_query}"
             else:
                 deeplink = base_tariff_deeplink
         else:
             # Для остальных тарифов добавляем маршрутные параметры
-            if route_params:
+            if route_query:
                 separator = "&" if "?" in base_tariff_deeplink else "?"
-                deeplink = f"{base_tariff_deeplink}{separator}{'&'.join(route_params)}"
+                deeplink = f"{base_tariff_deeplink}{separator}{route_query}"
             else:
                 deeplink = base_tariff_deeplink
     else:
         # Если нет базового тарифного диплинка (не должно происходить в новой логике)
-        if route_params:
-            deeplink = f"{scheme_prefix}route?{'&'.join(route_params)}"
+        if route_query:
+            deeplink = f"{scheme_prefix}route?{route_query}"
         else:
             deeplink = f"{scheme_prefix}route"
     
@@ -1089,48 +1289,38 @@ async def process_route_end(message: types.Message, state: FSMContext):
     await ask_desktop_url(message, state)
 
 
+# Любая %XX-последовательность означает, что значение href уже закодировано
+HREF_ENCODED_MARK_RE = re.compile(r'%[0-9A-Fa-f]{2}')
+HREF_RAW_SPECIAL_CHARS = frozenset(' :/?&=')
+
+
 @dp.message_handler(state=LinkBuilder.waiting_for_custom_deeplink)
 async def process_custom_deeplink(message: types.Message, state: FSMContext):
     """Обработка пользовательского диплинка"""
-    deeplink = message.text.strip()
+    deeplink = message.text
     
     if deeplink == BACK_BUTTON_TEXT:
         await prompt_action_type_with_state(message, state)
         return
 
     user_data = await state.get_data()
-    scheme_prefix = get_app_scheme(user_data.get("app"))
+    scheme_prefix = get_state_scheme(user_data)
 
     if not deeplink.startswith(scheme_prefix):
         await message.answer(f"❌ Диплинк должен начинаться с '{scheme_prefix}'. Попробуй ещё раз:")
         return
     
     # Проверяем наличие параметра href и автоматически кодируем его при необходимости
-    if "href=" in deeplink:
-        try:
-            # Извлекаем часть после scheme://
-            deeplink_part = deeplink[len(scheme_prefix):]
-            
-            # Ищем позицию href= в диплинке
-            href_pos = deeplink_part.find("href=")
-            if href_pos != -1:
-                # Разделяем на части: до href= и после href=
-                before_href = deeplink_part[:href_pos]
-                href_value = deeplink_part[href_pos + 5:]  # все после "href="
-                
-                # Проверяем, нуждается ли значение href в кодировании
-                needs_encoding = any(char in href_value for char in ['%20', '%3A', '%2F', '%3F', '%26', '%3D'])
-                
-                # Если значение содержит спецсимволы и не закодировано, кодируем его
-                if not needs_encoding and any(char in href_value for char in [' ', ':', '/', '?', '&', '=']):
-                    encoded_href = quote(href_value)
-                    
-                    # Пересобираем диплинк
-                    deeplink = f"{scheme_prefix}{before_href}href={encoded_href}"
-                        
-        except Exception as e:
-            await message.answer("❌ Ошибка при обработке диплинка. Попробуй ещё раз:")
-            return
+    deeplink_part, _ = split_deeplink(deeplink, scheme_prefix)
+    before_href, href_mark, href_value = deeplink_part.partition("href=")
+
+    # Значение href (всё после "href=") кодируем, если в нём есть спецсимволы и оно ещё не закодировано
+    if (
+        href_mark
+        and HREF_ENCODED_MARK_RE.search(href_value) is None
+        and not HREF_RAW_SPECIAL_CHARS.isdisjoint(href_value)
+    ):
+        deeplink = f"{scheme_prefix}{before_href}href={quote(href_value)}"
     
     await state.update_data(deeplink=deeplink)
     await ask_desktop_url(message, state)
@@ -1139,7 +1329,7 @@ async def process_custom_deeplink(message: types.Message, state: FSMContext):
 @dp.message_handler(state=LinkBuilder.waiting_for_promo_code)
 async def process_promo_code(message: types.Message, state: FSMContext):
     """Обработка промокода"""
-    promo_code = message.text.strip()
+    promo_code = message.text
     
     if promo_code == BACK_BUTTON_TEXT:
         await prompt_action_type_with_state(message, state)
@@ -1150,10 +1340,10 @@ async def process_promo_code(message: types.Message, state: FSMContext):
         return
     
     user_data = await state.get_data()
-    scheme_prefix = get_app_scheme(user_data.get("app"))
+    scheme_prefix = get_state_scheme(user_data)
 
     # URL-кодируем промокод
-    encoded_promo_code = quote(promo_code)
+    encoded_promo_code = quote_param(promo_code)
     
     # Формируем диплинк с промокодом
     deeplink = f"{scheme_prefix}addpromocode?code={encoded_promo_code}"
@@ -1165,19 +1355,7 @@ async def process_promo_code(message: types.Message, state: FSMContext):
 @dp.message_handler(state=LinkBuilder.waiting_for_tariff)
 async def process_tariff(message: types.Message, state: FSMContext):
     """Обработка выбора тарифа"""
-    user_data = await state.get_data()
-    scheme_prefix = get_app_scheme(user_data.get("app"))
-    tariff_map = {
-        "Эконом": f"{scheme_prefix}route?tariffClass=econom",
-        "Комфорт": f"{scheme_prefix}route?tariffClass=comfortplus",
-        "Комфорт+": f"{scheme_prefix}route?tariffClass=business",
-        "Бизнес": f"{scheme_prefix}route?tariffClass=vip&vertical=ultima",
-        "Грузовой": f"{scheme_prefix}route?tariffClass=cargo",
-        "Детский": f"{scheme_prefix}route?tariffClass=child_tariff",
-        "Межгород": f"{scheme_prefix}intercity_main"
-    }
-    
-    tariff_name = message.text.strip()
+    tariff_name = message.text
     
     if tariff_name == BACK_BUTTON_TEXT:
         await prompt_action_type_with_state(message, state)
@@ -1187,11 +1365,13 @@ async def process_tariff(message: types.Message, state: FSMContext):
         await prompt_custom_tariff(message)
         return
     
-    if tariff_name not in tariff_map:
+    if tariff_name not in TARIFF_DEEPLINK_PATHS:
         await message.answer("❌ Пожалуйста, выбери один из предложенных тарифов.")
         return
     
-    base_deeplink = tariff_map[tariff_name]
+    user_data = await state.get_data()
+    scheme_prefix = get_state_scheme(user_data)
+    base_deeplink = f"{scheme_prefix}{TARIFF_DEEPLINK_PATHS[tariff_name]}"
     await state.update_data(base_tariff_deeplink=base_deeplink)
     
     await prompt_route_start(message)
@@ -1200,7 +1380,7 @@ async def process_tariff(message: types.Message, state: FSMContext):
 @dp.message_handler(state=LinkBuilder.waiting_for_custom_tariff)
 async def process_custom_tariff(message: types.Message, state: FSMContext):
     """Обработка кода пользовательского тарифа"""
-    tariff_code = message.text.strip()
+    tariff_code = message.text
     
     if tariff_code == BACK_BUTTON_TEXT:
         await prompt_tariff(message)
@@ -1211,10 +1391,10 @@ async def process_custom_tariff(message: types.Message, state: FSMContext):
         return
     
     user_data = await state.get_data()
-    scheme_prefix = get_app_scheme(user_data.get("app"))
+    scheme_prefix = get_state_scheme(user_data)
 
     # URL-кодируем код тарифа
-    encoded_tariff_code = quote(tariff_code)
+    encoded_tariff_code = quote_param(tariff_code)
     
     # Формируем базовый диплинк с кодом тарифа
     base_deeplink = f"{scheme_prefix}route?tariffClass={encoded_tariff_code}"
@@ -1227,7 +1407,7 @@ async def process_custom_tariff(message: types.Message, state: FSMContext):
 @dp.message_handler(state=LinkBuilder.waiting_for_banner_id)
 async def process_banner_id(message: types.Message, state: FSMContext):
     """Обработка ID баннера"""
-    banner_id = message.text.strip()
+    banner_id = message.text
     
     if banner_id == BACK_BUTTON_TEXT:
         await prompt_action_type_with_state(message, state)
@@ -1238,10 +1418,10 @@ async def process_banner_id(message: types.Message, state: FSMContext):
         return
     
     user_data = await state.get_data()
-    scheme_prefix = get_app_scheme(user_data.get("app"))
+    scheme_prefix = get_state_scheme(user_data)
 
     # URL-кодируем ID баннера
-    encoded_banner_id = quote(banner_id)
+    encoded_banner_id = quote_param(banner_id)
     
     # Формируем диплинк с ID баннера
     deeplink = f"{scheme_prefix}banner?id={encoded_banner_id}"
@@ -1260,10 +1440,39 @@ async def ask_desktop_url(message: types.Message, state: FSMContext):
     await LinkBuilder.waiting_for_desktop_url.set()
 
 
+SHORTENER_URL_PREFIX = "https://go-admin-frontend.taxi.yandex-team.ru/adjust?url="
+# Неизменная часть ссылки на отчёт в Adjust, в конец дописываются кампания и адгруппа
+STATS_URL_PREFIX = (
+    "https://suite.adjust.com/datascape/report?"
+    "utc_offset=%2B00%3A00&reattributed=all&attribution_source=dynamic&"
+    "attribution_type=all&ad_spend_mode=network&date_period=-7d%3A-1d&"
+    "cohort_maturity=immature&sandbox=false&assisting_attribution_type=all&"
+    "ironsource_mode=ironsource&digital_turbine_mode=digital_turbine&"
+    "network__in=%22Promo+%28True+Link%29%22%2C%22Promo+Instant+Reattribution+%28True+Link%29%22%2C%22Promo+Instant+Reattribution+Temporary+30+%28True+Link%29%22%2C%22Promo+Temporary+30+%28True+Link%29%22&"
+    "dimensions=channel%2Ccampaign_network%2Cadgroup_network&"
+    "metrics=attribution_clicks%2Cinstalls%2Creattributions%2Csuccess_first_order_events&"
+    "sort=-installs&installs__column_heatmap=%23C19CFF&is_report_setup_open=true&"
+)
+
+# Итоговое сообщение с готовыми ссылками (HTML, значения подставляются экранированными)
+FINAL_REPLY_TEMPLATE = (
+    "🎉 Готово! Твоя ссылка:\n\n"
+    "<code>{final_link}</code>\n\n"
+    "🔗 <a href=\"{alt_link}\">Альтернативная ссылка</a>\n\n"
+    "📋 Скопируй ссылку выше и используй в своей кампании!\n\n"
+    "📱 Для использования в SMS или QR-кодах рекомендуется сократить ссылку:\n"
+    "<a href=\"{shortener_url}\">Перейти к сокращению ссылки</a>\n\n"
+    "📊 Для просмотра статистики переходов и установок:\n"
+    "<a href=\"{stats_url}\">Открыть статистику в Adjust</a>\n\n"
+    "🐞 Баги и пожелания: <a href=\"https://t.me/ibelousov\">igbelousov</a>\n\n"
+    "Чтобы создать новую ссылку, отправь /start"
+)
+
+
 @dp.message_handler(state=LinkBuilder.waiting_for_desktop_url)
 async def process_desktop_url(message: types.Message, state: FSMContext):
     """Обработка URL для десктопа"""
-    desktop_url = message.text.strip()
+    desktop_url = message.text
     
     if desktop_url == BACK_BUTTON_TEXT:
         user_data = await state.get_data()
@@ -1274,76 +1483,62 @@ async def process_desktop_url(message: types.Message, state: FSMContext):
             await prompt_route_end(message)
             return
         
-        if action_type == "Промокод":
-            await prompt_promo_code(message)
-            return
-        
-        if action_type == "Баннер":
-            await prompt_banner_id(message)
-            return
-        
-        if action_type == "Свой диплинк":
-            await prompt_custom_deeplink(message, state)
-            return
-
-        if action_type == "Сервис":
-            await prompt_service(message)
-            return
-        
-        await prompt_action_type_with_state(message, state)
+        back_prompt = BACK_FROM_DESKTOP_PROMPTS.get(action_type, prompt_action_type_with_state)
+        await back_prompt(message, state)
         return
 
-    if desktop_url.lower() != "пропустить":
-        if not is_valid_url(desktop_url):
-            await message.answer("❌ Введи корректный URL (должен начинаться с http:// или https://). Попробуй ещё раз:")
-            return
-        await state.update_data(desktop_url=desktop_url)
+    skip_desktop_url = is_skip_text(desktop_url)
+    if not skip_desktop_url and not is_valid_url(desktop_url):
+        await message.answer("❌ Введи корректный URL (должен начинаться с http:// или https://). Попробуй ещё раз:")
+        return
     
-    # Генерируем финальную ссылку
+    # Генерируем финальную ссылку. После этого шага состояние сбрасывается,
+    # поэтому URL не записываем в хранилище, а только подставляем в прочитанные данные
     user_data = await state.get_data()
-    final_link = build_final_link(user_data)
-    alt_link = build_adjust_app_link(user_data)
+    if not skip_desktop_url:
+        user_data['desktop_url'] = desktop_url
+    adgroup_value = get_adgroup_value(user_data)
+    link_args = (
+        user_data.get('app', GO_APP_NAME),
+        user_data.get('deeplink', ''),
+        adgroup_value,
+        user_data.get('reattribution', 'Только неактивных от 30 дней'),
+        user_data.get('temporary_attribution', 'Без ограничений'),
+        user_data.get('adj_t_override'),
+        user_data.get('desktop_url')
+    )
+    final_link = build_final_link(*link_args)
+    alt_link = build_adjust_app_link(*link_args)
     
     # Создаём ссылку для сокращения
     encoded_link = quote(final_link)
-    shortener_url = f"https://go-admin-frontend.taxi.yandex-team.ru/adjust?url={encoded_link}"
+    shortener_url = SHORTENER_URL_PREFIX + encoded_link
     
     # Создаем ссылку на статистику
-    today = datetime.now().strftime('%Y%m%d')
+    today = get_today_str()
     campaign_value = f'{today}_bot'
-    adgroup_value = transliterate_to_latin(user_data.get('campaign_name', ''))
     
-    # Кодируем параметры для ссылки на статистику
-    encoded_campaign = quote(f'"{campaign_value}"')
-    encoded_adgroup = quote(f'"{adgroup_value}"')
+    # Значения для фильтров статистики берутся в кавычки; сами они из [a-z0-9_],
+    # поэтому кодировать нужно только кавычки
+    encoded_campaign = f'%22{campaign_value}%22'
+    encoded_adgroup = f'%22{adgroup_value}%22'
     
     stats_url = (
-        "https://suite.adjust.com/datascape/report?"
-        "utc_offset=%2B00%3A00&reattributed=all&attribution_source=dynamic&"
-        "attribution_type=all&ad_spend_mode=network&date_period=-7d%3A-1d&"
-        "cohort_maturity=immature&sandbox=false&assisting_attribution_type=all&"
-        "ironsource_mode=ironsource&digital_turbine_mode=digital_turbine&"
-        "network__in=%22Promo+%28True+Link%29%22%2C%22Promo+Instant+Reattribution+%28True+Link%29%22%2C%22Promo+Instant+Reattribution+Temporary+30+%28True+Link%29%22%2C%22Promo+Temporary+30+%28True+Link%29%22&"
-        "dimensions=channel%2Ccampaign_network%2Cadgroup_network&"
-        "metrics=attribution_clicks%2Cinstalls%2Creattributions%2Csuccess_first_order_events&"
-        "sort=-installs&installs__column_heatmap=%23C19CFF&is_report_setup_open=true&"
+        f"{STATS_URL_PREFIX}"
         f"campaign_network__in__column={encoded_campaign}&"
         f"adgroup_network__in__column={encoded_adgroup}"
     )
     
     await message.answer(
-        f"🎉 Готово! Твоя ссылка:\n\n"
-        f"`{final_link}`\n\n"
-        f"🔗 [Альтернативная ссылка]({alt_link})\n\n"
-        f"📋 Скопируй ссылку выше и используй в своей кампании!\n\n"
-        f"📱 Для использования в SMS или QR-кодах рекомендуется сократить ссылку:\n"
-        f"[Перейти к сокращению ссылки]({shortener_url})\n\n"
-        f"📊 Для просмотра статистики переходов и установок:\n"
-        f"[Открыть статистику в Adjust]({stats_url})\n\n"
-        f"🐞 Баги и пожелания: [igbelousov](https://t.me/ibelousov)\n\n"
-        f"Чтобы создать новую ссылку, отправь /start",
-        reply_markup=ReplyKeyboardRemove(),
-        parse_mode='Markdown'
+        FINAL_REPLY_TEMPLATE.format_map({
+            'final_link': escape(final_link),
+            'alt_link': escape(alt_link),
+            'shortener_url': escape(shortener_url),
+            'stats_url': escape(stats_url)
+        }),
+        reply_markup=REMOVE_KEYBOARD,
+        parse_mode='HTML',
+        disable_web_page_preview=True
     )
     
     await state.finish()
@@ -1357,6 +1552,36 @@ async def handle_other_messages(message: types.Message):
     )
 
 
+class SecretWebhookRequestHandler(WebhookRequestHandler):
+    """Принимает обновления только с верным секретом вебхука"""
+
+    async def post(self):
+        secret = self.request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            logging.warning("Отклонён запрос к вебхуку с неверным секретом")
+            raise web.HTTPUnauthorized()
+        return await super().post()
+
+
+async def on_startup_webhook(dispatcher: Dispatcher) -> None:
+    await bot.set_webhook(
+        f"{WEBHOOK_HOST}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=["message"],
+        drop_pending_updates=WEBHOOK_DROP_PENDING_UPDATES
+    )
+
+
 if __name__ == '__main__':
     print("🚀 Запуск бота...")
-    executor.start_polling(dp, skip_updates=True)
\ No newline at end of file
+    if WEBHOOK_HOST:
+        webhook_executor = executor.Executor(dp)
+        webhook_executor.on_startup(on_startup_webhook)
+        webhook_executor.start_webhook(
+            webhook_path=WEBHOOK_PATH,
+            request_handler=SecretWebhookRequestHandler,
+            host=WEBAPP_HOST,
+            port=WEBAPP_PORT
+        )
+    else:
+        executor.start_polling(dp, skip_updates=True)
\ No newline at end of file